@@ -6,10 +6,11 @@ resnext_101_32_path = "resnext_101_32x4d.pth"
 
 
 class ResNeXt101(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super(ResNeXt101, self).__init__()
         net = resnext_101_32x4d_.resnext_101_32x4d
-        net.load_state_dict(torch.load(resnext_101_32_path))
+        if pretrained:
+            net.load_state_dict(torch.load(resnext_101_32_path))
 
         net = list(net.children())
         self.layer0 = nn.Sequential(*net[:3])
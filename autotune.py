@@ -0,0 +1,220 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import torch
+
+PROFILE_DIR = os.path.expanduser("~/.cache/dlcv_pipeline")
+
+DEFAULTS = {"batch_size": 8, "workers": 1}
+
+
+# one profile per machine, DLCV_AUTOTUNE_PROFILE points to a different file
+def profile_path():
+    return os.environ.get(
+        "DLCV_AUTOTUNE_PROFILE",
+        os.path.join(PROFILE_DIR, f"autotune-{socket.gethostname()}.json"),
+    )
+
+
+def load_profile(path=None):
+    path = path or profile_path()
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _limit_threads(threads):
+    # environment variables only reach libraries loaded later and child processes
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    torch.set_num_threads(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+
+
+_settings = {}
+_current = None
+
+
+# the settings of a model in the saved profile of this machine, read once per model
+def profile_settings(path=None, model="istd"):
+    if (path, model) not in _settings:
+        profile = load_profile(path) or {}
+        settings = dict(DEFAULTS)
+        settings.update(profile.get("best", {}))
+        settings.update(profile.get("models", {}).get(model, {}))
+        _settings[path, model] = settings
+    return _settings[path, model]
+
+
+# apply the thread settings tuned for model, called where the model is chosen
+# threads are set again whenever the model changes, interop threads only the first
+# time since torch fixes them once parallel work has started
+def apply_profile(path=None, model="istd"):
+    global _current
+    settings = profile_settings(path, model)
+    if _current == (path, model):
+        return settings
+
+    if "num_threads" in settings:
+        _limit_threads(settings["num_threads"])
+    if "interop_threads" in settings:
+        try:
+            torch.set_num_interop_threads(settings["interop_threads"])
+        except RuntimeError:
+            # interop threads can only be set before the first parallel work
+            pass
+
+    _current = (path, model)
+    return settings
+
+
+def setting(name, model="istd"):
+    return profile_settings(model=model).get(name, DEFAULTS.get(name))
+
+
+def _bench_model(name, threads, interop, batch_size, size, repeats):
+    from train import build_model
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(interop)
+    net = build_model(name, pretrained=False).eval()
+    x = torch.randn(batch_size, 3, size, size)
+
+    with torch.no_grad():
+        net(x)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            net(x)
+    return batch_size * repeats / (time.perf_counter() - start)
+
+
+def _cluster_frame(mask, levels=0):
+    from shadow_clusters import cluster_shadows
+
+    return len(cluster_shadows(mask, levels=levels))
+
+
+# frames in flight on threads of one process, as pipeline.py runs them, with the
+# clustering of pipeline.py --levels
+def _bench_postprocess(workers, threads, shape, frames, levels=0):
+    from shadow_clusters import synthetic_shadow_mask
+
+    _limit_threads(threads)
+    masks = [synthetic_shadow_mask(shape, seed=i) for i in range(frames)]
+
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(_cluster_frame, masks[:workers], [levels] * workers))
+        start = time.perf_counter()
+        list(pool.map(_cluster_frame, masks, [levels] * frames))
+    return frames / (time.perf_counter() - start)
+
+
+# every trial runs in a fresh process, since interop threads are fixed per process
+def _trial(fn, *args):
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def autotune(args):
+    cpus = os.cpu_count() or 1
+    threads = args.threads or sorted({1, 2, 4, 8, cpus} & set(range(1, cpus + 1)))
+    results = []
+
+    model_best = None
+    for t, interop, batch_size in itertools.product(threads, args.interop, args.batch_sizes):
+        rate = _trial(_bench_model, args.model, t, interop, batch_size, args.size, args.repeats)
+        results.append(
+            {
+                "stage": args.model,
+                "model": args.model,
+                "num_threads": t,
+                "interop_threads": interop,
+                "batch_size": batch_size,
+                "samples_per_s": rate,
+            }
+        )
+        print(f"{args.model}: threads {t}, interop {interop}, batch {batch_size}: {rate:.2f} samples/s")
+        if model_best is None or rate > model_best["samples_per_s"]:
+            model_best = results[-1]
+
+    # frames run with the thread setting of the model, which is what apply_profile sets,
+    # so the worker count is saved with the model too
+    post_best = None
+    threads = model_best["num_threads"]
+    for workers in args.workers or sorted({1, 2, 4, cpus} & set(range(1, cpus + 1))):
+        rate = _trial(
+            _bench_postprocess, workers, threads, tuple(args.mask_shape), args.frames, args.levels
+        )
+        results.append(
+            {
+                "stage": "postprocess",
+                "model": args.model,
+                "workers": workers,
+                "num_threads": threads,
+                "levels": args.levels,
+                "frames_per_s": rate,
+            }
+        )
+        print(f"postprocess: {workers} frames x {threads} threads: {rate:.2f} frames/s")
+        if post_best is None or rate > post_best["frames_per_s"]:
+            post_best = results[-1]
+
+    # the settings of other models tuned before on this machine are kept
+    path = args.out or profile_path()
+    previous = load_profile(path) or {}
+    models = previous.get("models", {})
+    models[args.model] = {
+        "num_threads": model_best["num_threads"],
+        "interop_threads": model_best["interop_threads"],
+        "batch_size": model_best["batch_size"],
+        "workers": post_best["workers"],
+    }
+    profile = {
+        "host": socket.gethostname(),
+        "cpus": cpus,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "model": args.model,
+        "models": models,
+        "results": [r for r in previous.get("results", []) if r.get("model") != args.model]
+        + results,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+    print(f"Saved profile to {path}: {models[args.model]}")
+    return profile
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Find the fastest thread and batch settings")
+    parser.add_argument("--model", choices=["istd", "mine"], default="istd")
+    parser.add_argument("--threads", type=int, nargs="+")
+    parser.add_argument("--interop", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--workers", type=int, nargs="+")
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--mask-shape", type=int, nargs=2, default=[1080, 1920])
+    parser.add_argument("--frames", type=int, default=8)
+    parser.add_argument(
+        "--levels", type=int, default=0, help="cluster_shadows levels, as in pipeline.py --levels"
+    )
+    parser.add_argument("--out", help="profile file, by default the one of this machine")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    autotune(parse_args())
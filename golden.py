@@ -0,0 +1,401 @@
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+
+from mask_ops import PackedMask
+from pipeline import Stage, shadow_pipeline
+from scene import combine_objects, load_depth, load_fov, objects_union
+from shadow_clusters import ClusterIndex
+
+# execution modes compared against the fp32 reference, add new speed modes here
+MODES = {
+    "fp32": {},
+    "bf16": {"bf16": True},
+    "roi": {"roi": True},
+    "coarse1": {"levels": 1},
+    "coarse2": {"levels": 2},
+    "grid": {"grid": True},
+}
+# options that only change how the shadow model runs, these modes can't be
+# compared without a checkpoint
+MODEL_OPTIONS = ("bf16", "roi")
+DEFAULT_MODES = [mode for mode in MODES if mode != "fp32"]
+
+THRESHOLDS = {
+    "mask_iou": 0.95,
+    "centroid_px": 4.0,
+    "density_px": 12.0,
+    "point_err": 0.01,
+}
+
+# clusters further apart than this are not the same cluster
+MATCH_PX = 24
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+DEFAULT_FOV = (60.0, 47.0)
+
+
+# a scene of elliptical objects, each casting a shadow in the same direction
+def synthetic_case(seed, shape=(480, 640), n_objects=3):
+    rng = np.random.default_rng(seed)
+    H, W = shape
+    shadow = np.zeros(shape, dtype=np.uint8)
+    objects = []
+    dx, dy = rng.uniform(-1, 1, 2)
+
+    for _ in range(n_objects):
+        obj = np.zeros(shape, dtype=np.uint8)
+        center = np.array([rng.uniform(0.2, 0.8) * W, rng.uniform(0.2, 0.8) * H])
+        axes = (int(rng.uniform(0.04, 0.1) * W), int(rng.uniform(0.06, 0.14) * H))
+        cv2.ellipse(obj, tuple(int(v) for v in center), axes, 0, 0, 360, 1, -1)
+        offset = np.array([dx * axes[0], dy * axes[1]]) * 1.5
+        shadow_axes = (int(axes[0] * 1.3), int(axes[1] * 0.8))
+        cv2.ellipse(
+            shadow,
+            tuple(int(v) for v in center + offset),
+            shadow_axes,
+            rng.uniform(0, 180),
+            0,
+            360,
+            255,
+            -1,
+        )
+        objects.append(obj)
+
+    shadow[rng.random(shape) > 0.999] = 255
+    depth = np.linspace(0.9, 0.3, H, dtype=np.float32)[:, None].repeat(W, axis=1)
+    return {
+        "name": f"synthetic-{seed}",
+        "image": None,
+        "shadow": shadow,
+        "objects": objects,
+        "depth": depth,
+        "fov": DEFAULT_FOV,
+    }
+
+
+# an image of original_test_images, with MoGe depth and fov when they are available
+def image_case(image_path, yolo=None, moge_dir="moge_outputs"):
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    image = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2RGB)
+    H, W = image.shape[:2]
+
+    objects = []
+    if yolo is not None:
+        from scene import segment_objects
+
+        objects = segment_objects(yolo, image)
+
+    depth_path = os.path.join(moge_dir, name, "depth_vis.png")
+    fov_path = os.path.join(moge_dir, name, "fov.json")
+    if os.path.exists(depth_path):
+        depth = cv2.resize(load_depth(depth_path), (W, H))
+    else:
+        depth = np.linspace(0.9, 0.3, H, dtype=np.float32)[:, None].repeat(W, axis=1)
+    fov = load_fov(fov_path) if os.path.exists(fov_path) else DEFAULT_FOV
+
+    return {
+        "name": name,
+        "image": image_path,
+        "shadow": None,
+        "objects": objects,
+        "depth": depth,
+        "fov": fov,
+    }
+
+
+def load_cases(args):
+    model_ready = os.path.exists(args.model) and os.path.exists("resnext_101_32x4d.pth")
+    if args.images and model_ready and not args.synthetic:
+        yolo = None
+        try:
+            from ultralytics import YOLO
+
+            yolo = YOLO("yolov8s-seg.pt")
+        except ImportError:
+            print("ultralytics is not installed, running without objects")
+        paths = sorted(
+            os.path.join(args.images, name)
+            for name in os.listdir(args.images)
+            if name.lower().endswith(IMAGE_EXTS)
+        )
+        return [image_case(path, yolo) for path in paths], True
+
+    print("No checkpoints found, using synthetic inputs")
+    n = args.synthetic or 5
+    return [synthetic_case(seed) for seed in range(n)], False
+
+
+def predict_shadow(net, case, mode, device):
+    from shadow_predict import load_image, object_rois, postprocess, predict_rois, preprocess
+
+    with torch.autocast(device.type, dtype=torch.bfloat16, enabled=mode.get("bf16", False)):
+        if mode.get("roi") and case["objects"]:
+            image, _ = load_image(case["image"])
+            rois = object_rois(combine_objects(case["objects"]))
+            return predict_rois(net, image, rois, device)
+
+        image, size = load_image(case["image"], draft_size=(256, 256))
+        with torch.no_grad():
+            pred = net(preprocess([image]).to(device))
+        return postprocess(pred.float(), size)[0]
+
+
+# the stages of pipeline.shadow_pipeline on the objects, depth and fov of a case,
+# with the run time of every stage
+def run_case(case, mode, net=None, device=None, is_in_frustum=1):
+    pipeline = shadow_pipeline(
+        is_in_frustum=is_in_frustum, max_workers=1, levels=mode.get("levels", 0)
+    )
+    # the shadow mask comes from the case or the model in this mode, and the object
+    # union takes its shape from it since synthetic cases have no image
+    pipeline.stages["shadow"] = Stage(
+        "shadow",
+        lambda: case["shadow"] if net is None else predict_shadow(net, case, mode, device),
+    )
+    pipeline.stages["all_objects"] = Stage(
+        "all_objects",
+        lambda objects, shadow: objects_union(objects, shadow.shape[:2]),
+        ["objects", "shadow"],
+    )
+    if mode.get("grid"):
+        pipeline.stages["clusters"] = Stage(
+            "clusters", lambda mask: ClusterIndex(mask).clusters(), ["shadow_mask"]
+        )
+
+    timings = {}
+    results = pipeline.run(
+        ["shadow_mask", "clusters", "pairs"],
+        timings=timings,
+        objects=case["objects"],
+        depth=case["depth"],
+        fov=case["fov"],
+    )
+    return {
+        "mask": results["shadow_mask"],
+        "clusters": results["clusters"],
+        "pairs": results["pairs"],
+        "timings": timings,
+    }
+
+
+def save_result(path, result):
+    clusters = np.array(
+        [
+            [c["label"], c["size"], *c["bbox"], *c["centroid"], *c["density"]]
+            for c in result["clusters"]
+        ],
+        dtype=np.int64,
+    ).reshape(-1, 10)
+    np.savez_compressed(
+        path,
+        mask_bits=result["mask"].bits,
+        mask_shape=np.array(result["mask"].shape),
+        clusters=clusters,
+        pair_names=np.array([p["name"] for p in result["pairs"]], dtype=str),
+        pairs=np.array(
+            [[p["shadow"], p["object"]] for p in result["pairs"]], dtype=np.float64
+        ).reshape(-1, 2, 3),
+        timings=json.dumps(result["timings"]),
+    )
+
+
+def load_result(path):
+    data = np.load(path)
+    clusters = [
+        {
+            "label": int(row[0]),
+            "size": int(row[1]),
+            "bbox": tuple(int(v) for v in row[2:6]),
+            "centroid": tuple(int(v) for v in row[6:8]),
+            "density": tuple(int(v) for v in row[8:10]),
+        }
+        for row in data["clusters"]
+    ]
+    pairs = [
+        {"name": str(name), "shadow": pair[0], "object": pair[1]}
+        for name, pair in zip(data["pair_names"], data["pairs"])
+    ]
+    return {
+        "mask": PackedMask(data["mask_bits"], data["mask_shape"]),
+        "clusters": clusters,
+        "pairs": pairs,
+        "timings": json.loads(str(data["timings"])),
+    }
+
+
+def mask_iou(a, b):
+    union = (a | b).area()
+    return 1.0 if union == 0 else (a & b).area() / union
+
+
+# one-to-one matching of clusters by their box centres
+def match_cluster_lists(ref, alt):
+    if not ref or not alt:
+        return []
+    a = np.array([c["centroid"] for c in ref], dtype=np.float64)
+    b = np.array([c["centroid"] for c in alt], dtype=np.float64)
+    cost = np.linalg.norm(a[:, None] - b[None], axis=2)
+    rows, cols = linear_sum_assignment(cost)
+    return [(r, c) for r, c in zip(rows, cols) if cost[r, c] <= MATCH_PX]
+
+
+def compare(ref, alt):
+    matches = match_cluster_lists(ref["clusters"], alt["clusters"])
+
+    def error(key):
+        errs = [
+            np.linalg.norm(
+                np.subtract(ref["clusters"][r][key], alt["clusters"][c][key])
+            )
+            for r, c in matches
+        ]
+        return float(max(errs, default=0.0))
+
+    alt_pairs = {p["name"]: p for p in alt["pairs"]}
+    point_err = 0.0
+    for pair in ref["pairs"]:
+        other = alt_pairs.get(pair["name"])
+        if other is None:
+            point_err = float("inf")
+            continue
+        for key in ("shadow", "object"):
+            point_err = max(point_err, float(np.linalg.norm(pair[key] - other[key])))
+    if len(alt["pairs"]) != len(ref["pairs"]):
+        point_err = float("inf")
+
+    metrics = {
+        "mask_iou": mask_iou(ref["mask"], alt["mask"]),
+        "clusters_ref": len(ref["clusters"]),
+        "clusters_alt": len(alt["clusters"]),
+        "clusters_matched": len(matches),
+        "centroid_px": error("centroid"),
+        "density_px": error("density"),
+        "point_err": point_err,
+        "time": sum(alt["timings"].values()),
+        "ref_time": sum(ref["timings"].values()),
+    }
+    metrics["passed"] = (
+        metrics["mask_iou"] >= THRESHOLDS["mask_iou"]
+        and metrics["clusters_ref"] == metrics["clusters_alt"] == metrics["clusters_matched"]
+        and metrics["centroid_px"] <= THRESHOLDS["centroid_px"]
+        and metrics["density_px"] <= THRESHOLDS["density_px"]
+        and metrics["point_err"] <= THRESHOLDS["point_err"]
+    )
+    return metrics
+
+
+def write_report(path, rows):
+    lines = [
+        "# Golden output comparison",
+        "",
+        "Thresholds: " + ", ".join(f"{k} {v}" for k, v in THRESHOLDS.items()),
+        "",
+        "| mode | case | mask IoU | clusters (ref/alt/matched) | centroid px "
+        "| density px | point err | time s | speedup | pass |",
+        "|---|---|---|---|---|---|---|---|---|---|",
+    ]
+    for mode, case, m in rows:
+        if m is None:
+            lines.append(f"| {mode} | {case} | n/a |" + " |" * 6 + " n/a |")
+            continue
+        lines.append(
+            f"| {mode} | {case} | {m['mask_iou']:.4f} "
+            f"| {m['clusters_ref']}/{m['clusters_alt']}/{m['clusters_matched']} "
+            f"| {m['centroid_px']:.2f} | {m['density_px']:.2f} | {m['point_err']:.4f} "
+            f"| {m['time']:.3f} | {m['ref_time'] / max(m['time'], 1e-9):.2f}x "
+            f"| {'yes' if m['passed'] else 'NO'} |"
+        )
+
+    lines += [
+        "",
+        "## Speed vs accuracy",
+        "",
+        "| mode | min mask IoU | max centroid px | max point err | speedup | passed |",
+        "|---|---|---|---|---|---|",
+    ]
+    for mode in dict.fromkeys(r[0] for r in rows):
+        ms = [m for r_mode, _, m in rows if r_mode == mode and m is not None]
+        if not ms:
+            lines.append(f"| {mode} | n/a | | | | n/a (no shadow model) |")
+            continue
+        speedup = sum(m["ref_time"] for m in ms) / max(sum(m["time"] for m in ms), 1e-9)
+        lines.append(
+            f"| {mode} | {min(m['mask_iou'] for m in ms):.4f} "
+            f"| {max(m['centroid_px'] for m in ms):.2f} "
+            f"| {max(m['point_err'] for m in ms):.4f} | {speedup:.2f}x "
+            f"| {sum(m['passed'] for m in ms)}/{len(ms)} |"
+        )
+
+    report = "\n".join(lines) + "\n"
+    with open(path, "w") as f:
+        f.write(report)
+    return report
+
+
+def _setup(args):
+    cases, real = load_cases(args)
+    net, device = None, None
+    if real:
+        from shadow_predict import get_device, load_ISTD
+
+        device = get_device()
+        net = load_ISTD(args.model, device)
+    return cases, net, device
+
+
+def record(args):
+    cases, net, device = _setup(args)
+    os.makedirs(args.golden, exist_ok=True)
+    for case in cases:
+        result = run_case(case, MODES["fp32"], net, device)
+        save_result(os.path.join(args.golden, case["name"] + ".npz"), result)
+        print(f"Recorded {case['name']}: {len(result['clusters'])} clusters")
+
+
+def compare_modes(args):
+    cases, net, device = _setup(args)
+    rows = []
+    for mode in args.modes:
+        skip = net is None and any(MODES[mode].get(o) for o in MODEL_OPTIONS)
+        if skip:
+            print(f"No shadow model, {mode} is reported as n/a")
+        for case in cases:
+            ref_path = os.path.join(args.golden, case["name"] + ".npz")
+            if not os.path.exists(ref_path):
+                print(f"No reference for {case['name']}, run record first")
+                continue
+            if skip:
+                rows.append((mode, case["name"], None))
+                continue
+            alt = run_case(case, MODES[mode], net, device)
+            rows.append((mode, case["name"], compare(load_result(ref_path), alt)))
+
+    report = write_report(args.report or os.path.join(args.golden, "report.md"), rows)
+    print(report)
+    return all(m["passed"] for _, _, m in rows if m is not None)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Golden output regression checks")
+    parser.add_argument("command", choices=["record", "compare"])
+    parser.add_argument("--golden", default="golden")
+    parser.add_argument("--images", default="original_test_images")
+    parser.add_argument("--model", default="models/ISTD_resnet.pth")
+    parser.add_argument("--synthetic", type=int, default=0, help="force N synthetic cases")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=DEFAULT_MODES)
+    parser.add_argument("--report")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "record":
+        record(args)
+    elif not compare_modes(args):
+        raise SystemExit(1)
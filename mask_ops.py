@@ -0,0 +1,171 @@
+import numpy as np
+import torch
+from PIL import Image
+
+# number of set bits for every possible byte, used when np.bitwise_count is missing
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(1)
+
+
+def _popcount(bits):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bits)
+    return _POPCOUNT[bits]
+
+
+# binary H x W mask stored as bit-packed rows (np.packbits along the width),
+# which is also the raw layout of a 1-bit PIL image
+class PackedMask:
+    def __init__(self, bits, shape):
+        self.bits = np.ascontiguousarray(bits, dtype=np.uint8)
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_array(cls, mask):
+        mask = np.asarray(mask)
+        # 3-channel masks such as masked_largest count a pixel if any channel is set
+        if mask.ndim == 3:
+            mask = mask.any(axis=2)
+        return cls(np.packbits(mask != 0, axis=1), mask.shape)
+
+    @classmethod
+    def from_tensor(cls, tensor, threshold=0.5):
+        # masks of shape (1, 1, H, W) or (1, H, W) keep their H x W shape, even 1 x W
+        tensor = tensor.detach().reshape(tensor.shape[-2:])
+        if tensor.is_floating_point():
+            tensor = tensor > threshold
+        return cls.from_array(tensor.cpu().numpy())
+
+    @classmethod
+    def from_png(cls, path, threshold=127):
+        return cls.from_image(Image.open(path), threshold)
+
+    # 1-bit images are used as they are, other modes are thresholded in greyscale
+    @classmethod
+    def from_image(cls, img, threshold=127):
+        if img.mode != "1":
+            img = img.convert("L").point(lambda v: 255 if v > threshold else 0, mode="1")
+        W, H = img.size
+        bits = np.frombuffer(img.tobytes(), dtype=np.uint8)
+        return cls(bits.reshape(H, -1), (H, W))
+
+    @classmethod
+    def zeros(cls, shape):
+        H, W = shape
+        return cls(np.zeros((H, (W + 7) // 8), dtype=np.uint8), shape)
+
+    @classmethod
+    def union_all(cls, masks, shape=None):
+        masks = list(masks)
+        if not masks:
+            return cls.zeros(shape)
+        bits = np.bitwise_or.reduce(np.stack([m.bits for m in masks]), axis=0)
+        return cls(bits, masks[0].shape)
+
+    def to_array(self, dtype=np.uint8):
+        return np.unpackbits(self.bits, axis=1, count=self.shape[1]).astype(
+            dtype, copy=False
+        )
+
+    def to_tensor(self, device=None):
+        return torch.from_numpy(self.to_array(np.bool_)).to(device)
+
+    def to_image(self):
+        H, W = self.shape
+        return Image.frombytes("1", (W, H), self.bits.tobytes())
+
+    def to_png(self, path):
+        self.to_image().save(path)
+
+    # padding bits at the end of every row must stay zero after inversion
+    def _tail(self):
+        pad = self.bits.shape[1] * 8 - self.shape[1]
+        return np.uint8((0xFF << pad) & 0xFF)
+
+    def _check(self, other):
+        if self.shape != other.shape:
+            raise ValueError(f"Mask shapes differ: {self.shape} and {other.shape}")
+
+    def __or__(self, other):
+        self._check(other)
+        return PackedMask(self.bits | other.bits, self.shape)
+
+    def __and__(self, other):
+        self._check(other)
+        return PackedMask(self.bits & other.bits, self.shape)
+
+    def __sub__(self, other):
+        self._check(other)
+        return PackedMask(self.bits & ~other.bits, self.shape)
+
+    def __xor__(self, other):
+        self._check(other)
+        return PackedMask(self.bits ^ other.bits, self.shape)
+
+    def __invert__(self):
+        bits = ~self.bits
+        if bits.shape[1]:
+            bits[:, -1] &= self._tail()
+        return PackedMask(bits, self.shape)
+
+    def __eq__(self, other):
+        if not isinstance(other, PackedMask):
+            return NotImplemented
+        return self.shape == other.shape and np.array_equal(self.bits, other.bits)
+
+    def __repr__(self):
+        return f"PackedMask(shape={self.shape}, area={self.area()})"
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def area(self):
+        return int(_popcount(self.bits).sum(dtype=np.int64))
+
+    def intersects(self, other):
+        self._check(other)
+        return bool(np.bitwise_and(self.bits, other.bits).any())
+
+    def overlap(self, other):
+        return (self & other).area()
+
+    def row_counts(self):
+        return _popcount(self.bits).sum(axis=1, dtype=np.int64)
+
+    def column_counts(self):
+        # count each bit position of the packed bytes without unpacking the whole mask
+        counts = np.empty((self.bits.shape[1], 8), dtype=np.int64)
+        for k in range(8):
+            counts[:, k] = ((self.bits >> (7 - k)) & 1).sum(axis=0, dtype=np.int64)
+        return counts.reshape(-1)[: self.shape[1]]
+
+    def bbox(self):
+        rows = np.flatnonzero(self.bits.any(axis=1))
+        if len(rows) == 0:
+            return None
+        cols = np.bitwise_or.reduce(self.bits[rows[0] : rows[-1] + 1], axis=0)
+        cols = np.flatnonzero(np.unpackbits(cols, count=self.shape[1]))
+        return int(cols[0]), int(rows[0]), int(cols[-1]), int(rows[-1])
+
+    def centroid(self):
+        rows = self.row_counts()
+        total = rows.sum()
+        if total == 0:
+            return None
+        ys = np.arange(self.shape[0])
+        xs = np.arange(self.shape[1])
+        return (
+            int((self.column_counts() * xs).sum() / total),
+            int((rows * ys).sum() / total),
+        )
+
+    def coordinates(self):
+        y, x = np.nonzero(self.to_array(np.bool_))
+        return np.column_stack((x, y))
+
+    def crop(self, x_min, y_min, x_max, y_max):
+        # only unpack the byte columns that cover the crop
+        b0 = x_min // 8
+        block = np.unpackbits(self.bits[y_min : y_max + 1, b0 : x_max // 8 + 1], axis=1)
+        offset = x_min - b0 * 8
+        return PackedMask.from_array(block[:, offset : offset + x_max - x_min + 1])
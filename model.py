@@ -1,8 +1,10 @@
 import torch
 import torch.nn as nn
+from torchvision.models import resnet34, ResNet34_Weights
 from ResNet import ResNeXt101
 
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 resnext_101_32_path = 'resnext_101_32x4d.pth'
 
 
@@ -64,9 +66,11 @@ class convZ(nn.Module):
         return self.conv(input)
 
 class SHADOW(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super(SHADOW, self).__init__()
-        resnext = ResNeXt101()
+        resnext = ResNeXt101(pretrained)
+        # recompute the ResNeXt stages in backward instead of storing their activations
+        self.checkpoint_backbone = False
 
         self.layer0 = resnext.layer0   #64  128*128
         self.layer1 = resnext.layer1   #256   64*64
@@ -101,11 +105,16 @@ class SHADOW(nn.Module):
         self.convx3 = nn.Conv2d(1024, 512, 3, padding=1)      #512   32*32
         self.convx4 = nn.Conv2d(2048, 1024, 3, padding=1)     # 1024  16*16
 
+    def stage(self, layer, x):
+        if self.checkpoint_backbone and self.training and torch.is_grad_enabled():
+            return checkpoint(layer, x, use_reentrant=False)
+        return layer(x)
+
     def forward(self, x):
-        layer0 = self.layer0(x)       #64    128
-        layer1 = self.layer1(layer0)  #256   64
-        layer2 = self.layer2(layer1)  #512   32
-        layer3 = self.layer3(layer2)  #1024  16
+        layer0 = self.stage(self.layer0, x)       #64    128
+        layer1 = self.stage(self.layer1, layer0)  #256   64
+        layer2 = self.stage(self.layer2, layer1)  #512   32
+        layer3 = self.stage(self.layer3, layer2)  #1024  16
 
 
         c1 = self.conv1(x)                 #////////////////// 64 256*256
@@ -145,3 +154,100 @@ class SHADOW(nn.Module):
 
         out = nn.Sigmoid()(c11)
         return out
+
+
+# model structure for my model: ISTD_mine_16.pth
+class ResNetUNet(nn.Module):
+    def __init__(self, pretrained=True):
+        super().__init__()
+        base_model = resnet34(weights=ResNet34_Weights.IMAGENET1K_V1 if pretrained else None)
+        self.base_layers = list(base_model.children())
+
+        self.layer0 = nn.Sequential(*self.base_layers[:3])
+        self.layer1 = nn.Sequential(*self.base_layers[3:5])
+        self.layer2 = self.base_layers[5]
+        self.layer3 = self.base_layers[6]
+        self.layer4 = self.base_layers[7]
+
+        self.up4 = nn.ConvTranspose2d(512, 256, 2, 2)
+        self.dec4 = nn.Sequential(
+            nn.Conv2d(512, 256, 3, padding=1),
+            nn.BatchNorm2d(256),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(256, 256, 3, padding=1),
+            nn.BatchNorm2d(256),
+            nn.ReLU(inplace=True),
+        )
+
+        self.up3 = nn.ConvTranspose2d(256, 128, 2, 2)
+        self.dec3 = nn.Sequential(
+            nn.Conv2d(256, 128, 3, padding=1),
+            nn.BatchNorm2d(128),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(128, 128, 3, padding=1),
+            nn.BatchNorm2d(128),
+            nn.ReLU(inplace=True),
+        )
+
+        self.up2 = nn.ConvTranspose2d(128, 64, 2, 2)
+        self.dec2 = nn.Sequential(
+            nn.Conv2d(128, 64, 3, padding=1),
+            nn.BatchNorm2d(64),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(64, 64, 3, padding=1),
+            nn.BatchNorm2d(64),
+            nn.ReLU(inplace=True),
+        )
+
+        self.up1 = nn.ConvTranspose2d(64, 64, 2, 2)
+        self.dec1 = nn.Sequential(
+            nn.Conv2d(128, 64, 3, padding=1),
+            nn.BatchNorm2d(64),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(64, 64, 3, padding=1),
+            nn.BatchNorm2d(64),
+            nn.ReLU(inplace=True),
+        )
+
+        self.out_conv = nn.Conv2d(64, 1, 1)
+
+    @staticmethod
+    def crop_to_fit(src, target):
+        _, _, h_src, w_src = src.shape
+        _, _, h_tgt, w_tgt = target.shape
+        crop_h = (h_src - h_tgt) // 2
+        crop_w = (w_src - w_tgt) // 2
+        return src[:, :, crop_h : (crop_h + h_tgt), crop_w : (crop_w + w_tgt)]
+
+    def forward(self, x):
+        x0 = self.layer0(x)
+        x1 = self.layer1(x0)
+        x2 = self.layer2(x1)
+        x3 = self.layer3(x2)
+        x4 = self.layer4(x3)
+
+        d4 = self.up4(x4)
+        x3_cropped = self.crop_to_fit(x3, d4)
+        d4 = torch.cat([d4, x3_cropped], dim=1)
+        d4 = self.dec4(d4)
+
+        d3 = self.up3(d4)
+        x2_cropped = self.crop_to_fit(x2, d3)
+        d3 = torch.cat([d3, x2_cropped], dim=1)
+        d3 = self.dec3(d3)
+
+        d2 = self.up2(d3)
+        x1_cropped = self.crop_to_fit(x1, d2)
+        d2 = torch.cat([d2, x1_cropped], dim=1)
+        d2 = self.dec2(d2)
+
+        d1 = self.up1(d2)
+        x0_cropped = self.crop_to_fit(x0, d1)
+        d1 = torch.cat([d1, x0_cropped], dim=1)
+        d1 = self.dec1(d1)
+
+        out = self.out_conv(d1)
+        out = nn.functional.interpolate(
+            out, size=x.shape[2:], mode="bilinear", align_corners=False
+        )
+        return torch.sigmoid(out)
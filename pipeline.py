@@ -0,0 +1,281 @@
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import cv2
+import torch
+
+from autotune import apply_profile, setting
+from scene import (
+    assign_shadows,
+    blender_script,
+    combine_objects,
+    compute_centroid,
+    load_depth,
+    load_fov,
+    object_targets,
+    objects_union,
+    point_pairs,
+    segment_objects,
+    subtract_objects,
+    target_centroids,
+)
+from shadow_clusters import cluster_shadows
+
+
+# one step of the pipeline, fn is called with the values of inputs in order
+class Stage:
+    def __init__(self, name, fn, inputs=()):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, inputs={self.inputs})"
+
+
+# runs only the stages needed for the requested outputs, independent stages run
+# concurrently on a thread pool (torch, cv2 and numpy release the GIL)
+class Pipeline:
+    def __init__(self, stages, max_workers=4):
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_workers = max_workers
+
+    def required(self, outputs, inputs=()):
+        needed = set()
+        todo = list(outputs)
+        while todo:
+            name = todo.pop()
+            if name in needed or name in inputs:
+                continue
+            if name not in self.stages:
+                raise KeyError(f"Missing input or stage: {name}")
+            needed.add(name)
+            todo.extend(self.stages[name].inputs)
+        return needed
+
+    # stages given in inputs are not run, timings collects the run time of every stage
+    def run(self, outputs, timings=None, **inputs):
+        values = dict(inputs)
+        pending = self.required(outputs, inputs)
+
+        def timed(name, fn, *args):
+            start = time.perf_counter()
+            value = fn(*args)
+            timings[name] = time.perf_counter() - start
+            return value
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            running = {}
+            while pending or running:
+                ready = [
+                    name
+                    for name in pending
+                    if all(i in values for i in self.stages[name].inputs)
+                ]
+                for name in ready:
+                    stage = self.stages[name]
+                    args = [values[i] for i in stage.inputs]
+                    if timings is None:
+                        running[pool.submit(stage.fn, *args)] = name
+                    else:
+                        running[pool.submit(timed, name, stage.fn, *args)] = name
+                    pending.discard(name)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    values[running.pop(future)] = future.result()
+
+        return {name: values[name] for name in outputs}
+
+
+def _read_rgb(image_path):
+    return cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2RGB)
+
+
+def _shadow(net, device):
+    def predict(image_path):
+        if net is None:
+            # the mask saved next to the image by run_ISTD or run_mine
+            base, _ = os.path.splitext(image_path)
+            return cv2.imread(base + "_mask.png", cv2.IMREAD_GRAYSCALE)
+
+        from shadow_predict import load_image, postprocess, preprocess
+
+        image, size = load_image(image_path, draft_size=(256, 256))
+        with torch.no_grad():
+            pred = net(preprocess([image]).to(device))
+        return postprocess(pred, size)[0]
+
+    return predict
+
+
+# YOLO predictors are not thread safe, so frames in flight take turns
+def _segment(yolo):
+    lock = threading.Lock()
+
+    def segment(image_rgb):
+        nonlocal yolo
+        with lock:
+            if yolo is None:
+                from ultralytics import YOLO
+
+                yolo = YOLO("yolov8s-seg.pt")
+            return segment_objects(yolo, image_rgb)
+
+    return segment
+
+
+# frames without detections get no targets, so they are stored without pairs
+def _combine(objects):
+    return combine_objects(objects) if objects else (None, None)
+
+
+def _targets(depth, combined):
+    largest, second = combined
+    if largest is None:
+        return []
+    return target_centroids(
+        depth,
+        largest=compute_centroid(largest),
+        second=compute_centroid(second) if second is not None else None,
+    )
+
+
+# the stages of shadow_mask_with_depth.ipynb without the plotting
+# inputs: image_path, depth_path, fov_path, name and color_flag (for the Blender script)
+# yolo is loaded on first use when not given and kept for the following runs
+# targets="largest" pairs the two largest objects as in the notebook, "all" every
+# detected object, with its box guiding assign_shadows
+def shadow_pipeline(
+    yolo=None,
+    net=None,
+    device=None,
+    is_in_frustum=1,
+    max_workers=4,
+    targets="largest",
+    **cluster_kwargs,
+):
+    if targets == "largest":
+        target_stages = [
+            Stage("combined", _combine, ["objects"]),
+            Stage("targets", _targets, ["depth", "combined"]),
+            Stage("nearest", assign_shadows, ["targets", "clusters", "depth"]),
+        ]
+    elif targets == "all":
+        target_stages = [
+            Stage("object_targets", object_targets, ["objects", "depth"]),
+            Stage("targets", lambda found: found[0], ["object_targets"]),
+            Stage(
+                "nearest",
+                lambda found, clusters, depth: assign_shadows(
+                    found[0], clusters, depth, object_boxes=found[1]
+                ),
+                ["object_targets", "clusters", "depth"],
+            ),
+        ]
+    else:
+        raise ValueError(f"Unknown targets: {targets}")
+
+    stages = [
+        Stage("image_rgb", _read_rgb, ["image_path"]),
+        Stage("objects", _segment(yolo), ["image_rgb"]),
+        Stage("shadow", _shadow(net, device), ["image_path"]),
+        Stage("depth", load_depth, ["depth_path"]),
+        Stage("fov", load_fov, ["fov_path"]),
+        Stage(
+            "all_objects",
+            lambda objects, image: objects_union(objects, image.shape[:2]),
+            ["objects", "image_rgb"],
+        ),
+        Stage("shadow_mask", subtract_objects, ["shadow", "all_objects"]),
+        Stage(
+            "clusters",
+            lambda mask: cluster_shadows(mask, **cluster_kwargs),
+            ["shadow_mask"],
+        ),
+        *target_stages,
+        Stage(
+            "pairs",
+            lambda targets, nearest, fov, depth: point_pairs(
+                targets, nearest, fov, (depth.shape[1], depth.shape[0]), is_in_frustum
+            ),
+            ["targets", "nearest", "fov", "depth"],
+        ),
+        Stage("blender", blender_script, ["name", "color_flag", "pairs"]),
+    ]
+    return Pipeline(stages, max_workers)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the shadow pipeline on a MoGe output")
+    parser.add_argument("moge_dirs", nargs="+", help="e.g. moge_outputs/test-3")
+    parser.add_argument("--outputs", nargs="+", default=["blender"])
+    parser.add_argument("--store", help="append the results to this result store instead")
+    parser.add_argument("--model", help="ISTD checkpoint, by default image_mask.png is read")
+    parser.add_argument("--levels", type=int, default=0)
+    parser.add_argument(
+        "--targets", choices=["largest", "all"], default="largest", help="objects to pair"
+    )
+    parser.add_argument("--not-in-frustum", action="store_true")
+    parser.add_argument(
+        "--workers", type=int, help="frames in flight, by default from the autotune profile"
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # the pipeline runs SHADOW, its frames in flight were tuned with its thread settings
+    apply_profile(model="istd")
+
+    net, device = None, None
+    if args.model:
+        from shadow_predict import get_device, load_ISTD
+
+        device = get_device()
+        net = load_ISTD(args.model, device)
+
+    pipeline = shadow_pipeline(
+        net=net,
+        device=device,
+        is_in_frustum=int(not args.not_in_frustum),
+        targets=args.targets,
+        levels=args.levels,
+    )
+    store = None
+    if args.store:
+        from result_store import ResultStore
+
+        store = ResultStore(args.store)
+        args.outputs = ["shadow_mask", "clusters", "targets", "pairs"]
+
+    def run_frame(moge_dir):
+        name = os.path.basename(os.path.normpath(moge_dir))
+        return name, pipeline.run(
+            args.outputs,
+            image_path=os.path.join(moge_dir, "image.jpg"),
+            depth_path=os.path.join(moge_dir, "depth_vis.png"),
+            fov_path=os.path.join(moge_dir, "fov.json"),
+            name=name,
+            color_flag=1,
+        )
+
+    # results come back in the order of moge_dirs, the frames appended to the store
+    # before an error are still flushed
+    saved = 0
+    try:
+        with ThreadPoolExecutor(args.workers or setting("workers")) as frames:
+            for name, results in frames.map(run_frame, args.moge_dirs):
+                if store is not None:
+                    store.append(name, *(results[output] for output in args.outputs))
+                    saved += 1
+                    continue
+                for output, value in results.items():
+                    print(value if isinstance(value, str) else f"{output}: {value}")
+    finally:
+        if store is not None:
+            store.flush()
+            print(f"Saved {saved} frames to {args.store}")
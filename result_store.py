@@ -0,0 +1,227 @@
+import argparse
+import glob
+import json
+import os
+import zlib
+
+import numpy as np
+
+from mask_ops import PackedMask
+from scene import blender_script
+
+# columns of every table, all rows carry the frame id they belong to
+TABLES = {
+    "frames": ["frame_id", "chunk", "offset", "nbytes", "height", "width"],
+    "clusters": [
+        "frame_id", "label", "size", "x_min", "y_min", "x_max", "y_max",
+        "centroid_x", "centroid_y", "density_x", "density_y",
+    ],
+    "objects": ["frame_id", "name", "x", "y", "z"],
+    "pairs": [
+        "frame_id", "name", "shadow_x", "shadow_y", "shadow_z",
+        "object_x", "object_y", "object_z",
+    ],
+}
+STRING_COLUMNS = {"frame_id", "name"}
+FLOAT_COLUMNS = {
+    "z", "shadow_x", "shadow_y", "shadow_z", "object_x", "object_y", "object_z",
+}
+
+
+# results of many frames in one directory: the bit-packed masks of a chunk are
+# concatenated in masks-<chunk>.bin (zlib per frame unless compress=False), and
+# every column of a table is one .npy per chunk in <table>-<chunk>/, so nothing
+# is written per frame and lookups only memory-map the chunks they touch
+class ResultStore:
+    def __init__(self, path, chunk_size=1024, compress=True):
+        self.path = path
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.compress = json.load(f)["compress"]
+        else:
+            self.compress = compress
+            with open(meta_path, "w") as f:
+                json.dump({"compress": compress}, f)
+
+        self.next_chunk = len(glob.glob(os.path.join(path, "masks-*.bin")))
+        self._buffer = {name: [] for name in TABLES}
+        self._buffered_ids = set()
+        self._blobs = []
+        self._offset = 0
+        self._index = None
+        self._columns = {}
+        self._chunks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def append(self, frame_id, mask, clusters=(), targets=(), pairs=()):
+        frame_id = str(frame_id)
+        if frame_id in self._buffered_ids or frame_id in self.index():
+            raise ValueError(f"Frame {frame_id} is already in the store")
+        self._buffered_ids.add(frame_id)
+
+        blob = mask.bits.tobytes()
+        if self.compress:
+            blob = zlib.compress(blob, 6)
+        self._buffer["frames"].append(
+            (frame_id, self.next_chunk, self._offset, len(blob), *mask.shape)
+        )
+        self._blobs.append(blob)
+        self._offset += len(blob)
+
+        for c in clusters:
+            self._buffer["clusters"].append(
+                (frame_id, c["label"], c.get("size", 0))
+                + (*c["bbox"], *c["centroid"], *c["density"])
+            )
+        for name, (x, y, z) in targets:
+            self._buffer["objects"].append((frame_id, name, x, y, z))
+        for p in pairs:
+            self._buffer["pairs"].append(
+                (frame_id, p["name"], *p["shadow"], *p["object"])
+            )
+
+        if len(self._blobs) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._blobs:
+            return
+        chunk = f"{self.next_chunk:05d}"
+        with open(os.path.join(self.path, f"masks-{chunk}.bin"), "wb") as f:
+            for blob in self._blobs:
+                f.write(blob)
+
+        for name, columns in TABLES.items():
+            rows = self._buffer[name]
+            table_dir = os.path.join(self.path, f"{name}-{chunk}")
+            os.makedirs(table_dir, exist_ok=True)
+            for i, column in enumerate(columns):
+                values = [row[i] for row in rows]
+                if column in STRING_COLUMNS:
+                    data = np.array(values, dtype=str)
+                elif column in FLOAT_COLUMNS:
+                    data = np.array(values, dtype=np.float64)
+                else:
+                    data = np.array(values, dtype=np.int64)
+                np.save(os.path.join(table_dir, f"{column}.npy"), data)
+
+        self.next_chunk += 1
+        self._buffer = {name: [] for name in TABLES}
+        self._buffered_ids = set()
+        self._blobs = []
+        self._offset = 0
+        self._index = None
+
+    # the columns of one chunk of a table, memory-mapped
+    def chunk_table(self, name, chunk):
+        if (name, chunk) not in self._columns:
+            table_dir = os.path.join(self.path, f"{name}-{chunk:05d}")
+            self._columns[name, chunk] = {
+                column: np.load(os.path.join(table_dir, f"{column}.npy"), mmap_mode="r")
+                for column in TABLES[name]
+            }
+        return self._columns[name, chunk]
+
+    # frame id -> (chunk, row in the frames table of that chunk)
+    def index(self):
+        if self._index is None:
+            self._index = {}
+            for chunk in range(self.next_chunk):
+                for row, frame_id in enumerate(self.chunk_table("frames", chunk)["frame_id"]):
+                    self._index[str(frame_id)] = (chunk, row)
+        return self._index
+
+    # every column of a table over all chunks, this reads the whole table
+    def table(self, name):
+        parts = [self.chunk_table(name, chunk) for chunk in range(self.next_chunk)]
+        return {
+            column: np.concatenate([p[column] for p in parts]) if parts else np.array([])
+            for column in TABLES[name]
+        }
+
+    def frame_ids(self):
+        return list(self.index())
+
+    # rows of the given frames, only the chunks holding them are read
+    def rows(self, name, frame_ids):
+        frame_ids = [str(frame_id) for frame_id in frame_ids]
+        index = self.index()
+        chunks = sorted({index[frame_id][0] for frame_id in frame_ids})
+        selected = []
+        for chunk in chunks:
+            table = self.chunk_table(name, chunk)
+            keep = np.isin(table["frame_id"], frame_ids)
+            selected.append({column: values[keep] for column, values in table.items()})
+        return {
+            column: np.concatenate([s[column] for s in selected])
+            if selected
+            else np.array([])
+            for column in TABLES[name]
+        }
+
+    def mask(self, frame_id):
+        chunk, row = self.index()[str(frame_id)]
+        frames = self.chunk_table("frames", chunk)
+
+        if chunk not in self._chunks:
+            chunk_path = os.path.join(self.path, f"masks-{chunk:05d}.bin")
+            self._chunks[chunk] = np.memmap(chunk_path, dtype=np.uint8, mode="r")
+        data = self._chunks[chunk]
+        offset, nbytes = int(frames["offset"][row]), int(frames["nbytes"][row])
+        blob = data[offset : offset + nbytes]
+        H, W = int(frames["height"][row]), int(frames["width"][row])
+        if self.compress:
+            blob = np.frombuffer(zlib.decompress(blob), dtype=np.uint8)
+        return PackedMask(np.array(blob).reshape(H, (W + 7) // 8), (H, W))
+
+    def masks(self, frame_ids):
+        return [self.mask(frame_id) for frame_id in frame_ids]
+
+    # Blender script of the selected frames, one block per frame
+    def blender_script(self, frame_ids=None, color_flag=1):
+        if frame_ids is None:
+            frame_ids = self.frame_ids()
+        rows = self.rows("pairs", frame_ids)
+        blocks = []
+        for frame_id in frame_ids:
+            selected = rows["frame_id"] == str(frame_id)
+            pairs = [
+                {
+                    "name": name,
+                    "shadow": (sx, sy, sz),
+                    "object": (ox, oy, oz),
+                }
+                for name, sx, sy, sz, ox, oy, oz in zip(
+                    rows["name"][selected],
+                    rows["shadow_x"][selected],
+                    rows["shadow_y"][selected],
+                    rows["shadow_z"][selected],
+                    rows["object_x"][selected],
+                    rows["object_y"][selected],
+                    rows["object_z"][selected],
+                )
+            ]
+            blocks.append(blender_script(str(frame_id), color_flag, pairs))
+        return "\n\n".join(blocks)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export results from a result store")
+    parser.add_argument("store")
+    parser.add_argument("--frames", nargs="+", help="frame ids, all frames by default")
+    parser.add_argument("--color-flag", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(ResultStore(args.store).blender_script(args.frames, args.color_flag))
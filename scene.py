@@ -0,0 +1,313 @@
+import json
+
+import cv2
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+
+from mask_ops import PackedMask
+
+
+# binary masks of every YOLO detection at the image resolution
+def segment_objects(model, image_rgb):
+    h, w = image_rgb.shape[:2]
+    results = model(image_rgb)[0]
+
+    resized_masks = []
+    if results.masks is None:
+        return resized_masks
+    for mask in results.masks.data:
+        mask_resized = torch.nn.functional.interpolate(
+            mask.unsqueeze(0).unsqueeze(0),
+            size=(h, w),
+            mode="bilinear",
+            align_corners=False,
+        )[0, 0]
+        binary_mask = (mask_resized > 0.5).cpu().numpy().astype(np.uint8)
+        resized_masks.append(binary_mask)
+    return resized_masks
+
+
+# the two biggest objects, each together with the other objects overlapping it
+def combine_objects(resized_masks):
+    if not resized_masks:
+        raise ValueError("No masks detected.")
+
+    packed = [PackedMask.from_array(mask) for mask in resized_masks]
+    areas = [mask.area() for mask in packed]
+
+    sorted_indices = np.argsort(areas)[::-1]
+    largest_index = sorted_indices[0]
+    second_index = sorted_indices[1] if len(sorted_indices) > 1 else None
+
+    largest_mask = packed[largest_index]
+    combined_largest_mask = largest_mask
+    for i in sorted_indices[1:]:
+        if i == second_index:
+            continue
+        if packed[i].intersects(largest_mask):
+            combined_largest_mask = combined_largest_mask | packed[i]
+
+    combined_second_mask = None
+    if second_index is not None:
+        second_mask = packed[second_index]
+        combined_second_mask = second_mask
+        for i in sorted_indices:
+            if i in (largest_index, second_index):
+                continue
+            if packed[i].intersects(second_mask):
+                combined_second_mask = combined_second_mask | packed[i]
+        combined_second_mask = combined_second_mask.to_array()
+
+    return combined_largest_mask.to_array(), combined_second_mask
+
+
+def compute_centroid(mask):
+    ys, xs = np.where(mask == 1)
+    if len(xs) == 0 or len(ys) == 0:
+        return None
+    return int(xs.mean()), int(ys.mean())
+
+
+def objects_union(resized_masks, shape):
+    return PackedMask.union_all(
+        (PackedMask.from_array(mask) for mask in resized_masks), shape
+    )
+
+
+# shadow pixels of a predicted mask (grey values above 127) that are not on any object
+def subtract_objects(shadow_mask, objects, threshold=127):
+    if shadow_mask.ndim == 3:
+        shadow_mask = cv2.cvtColor(shadow_mask, cv2.COLOR_RGB2GRAY)
+    return PackedMask.from_array(shadow_mask > threshold) - objects
+
+
+def load_depth(path):
+    depth_map = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+    if depth_map.ndim == 3:
+        depth_single = depth_map[:, :, 0].astype(np.float32)
+    else:
+        depth_single = depth_map.astype(np.float32)
+
+    if depth_map.dtype == np.uint8:
+        depth_single /= 255.0
+    elif depth_map.dtype == np.uint16:
+        depth_single /= 1000.0
+    return depth_single
+
+
+def load_fov(path):
+    with open(path, "r") as f:
+        data = json.load(f)
+    return data["fov_x"], data["fov_y"]
+
+
+def reconstruct_3d_centroid(centroid_2d, depth_map):
+    x, y = centroid_2d
+    z = float(depth_map[y, x])
+
+    return (x, y, z)
+
+
+# this euclidean distance function is for 3d coordinates
+def euclidean_distance(p1, p2):
+    return np.linalg.norm(np.array(p1) - np.array(p2))
+
+
+def target_centroids(depth_map, **centroids):
+    targets = []
+    for name, centroid in centroids.items():
+        if centroid is not None:
+            targets.append((name, reconstruct_3d_centroid(centroid, depth_map)))
+    return targets
+
+
+# the shadow cluster nearest in 3d to every target object
+def match_clusters(targets, boxes_centroids, depth_map):
+    valid_boxes = []
+    for i, b in enumerate(boxes_centroids):
+        if b is None or "centroid" not in b or b["centroid"] is None:
+            print(f"No boxes_centroids[{i}]")
+            continue
+
+        valid_boxes.append(b)
+
+    nearest_clusters = []
+
+    for name, target in targets:
+        distances = []
+        reconstructed_boxes = []
+
+        for b in valid_boxes:
+            centroid_3d = reconstruct_3d_centroid(b["centroid"], depth_map)
+            dist = euclidean_distance(target, centroid_3d)
+            distances.append(dist)
+            reconstructed_boxes.append(centroid_3d)
+
+        if not distances or all(d == np.inf for d in distances):
+            print(f"No valid clusters found for centroid {name}")
+            continue
+
+        nearest_index = np.argmin(distances)
+        nearest_box_centroid = valid_boxes[nearest_index]
+        centroid_3d = reconstructed_boxes[nearest_index]
+
+        nearest_clusters.append(
+            {
+                "name": name,
+                "label": nearest_box_centroid["label"],
+                "bbox": nearest_box_centroid["bbox"],
+                "centroid": centroid_3d,
+                "density": nearest_box_centroid["density"],
+                "distance": distances[nearest_index],
+            }
+        )
+    return nearest_clusters
+
+
+# every detected object as a target, named object-0, object-1, ... in mask order
+def object_targets(resized_masks, depth_map):
+    targets, boxes = [], []
+    for i, mask in enumerate(resized_masks):
+        packed = PackedMask.from_array(mask)
+        centroid = packed.centroid()
+        if centroid is None:
+            continue
+        targets.append((f"object-{i}", reconstruct_3d_centroid(centroid, depth_map)))
+        boxes.append(packed.bbox())
+    return targets, boxes
+
+
+def _box_overlap(boxes_a, boxes_b):
+    a = np.asarray(boxes_a, dtype=np.float64)[:, None]
+    b = np.asarray(boxes_b, dtype=np.float64)[None]
+    w = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]) + 1
+    h = np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]) + 1
+    inter = np.clip(w, 0, None) * np.clip(h, 0, None)
+    area_b = (b[..., 2] - b[..., 0] + 1) * (b[..., 3] - b[..., 1] + 1)
+    return inter / area_b
+
+
+# one shadow cluster per object, unlike match_clusters two objects can't claim the
+# same shadow: the object x cluster 3d distance matrix is solved with the Hungarian
+# algorithm. shadow_dir, the (dx, dy) image direction the shadows fall in, makes
+# clusters on the wrong side up to 1 + light_weight times further away, and
+# object_boxes makes clusters touching their object up to overlap_weight closer
+def assign_shadows(
+    targets,
+    boxes_centroids,
+    depth_map,
+    shadow_dir=None,
+    light_weight=1.0,
+    object_boxes=None,
+    overlap_weight=0.5,
+    max_distance=np.inf,
+):
+    valid_boxes = [
+        b for b in boxes_centroids if b is not None and b.get("centroid") is not None
+    ]
+    if not targets or not valid_boxes:
+        return []
+
+    objects = np.array([t for _, t in targets], dtype=np.float64)
+    centroids = np.array([b["centroid"] for b in valid_boxes])
+    clusters = np.column_stack(
+        (centroids, depth_map[centroids[:, 1], centroids[:, 0]])
+    ).astype(np.float64)
+
+    offsets = clusters[None] - objects[:, None]
+    cost = np.linalg.norm(offsets, axis=2)
+
+    if shadow_dir is not None:
+        direction = np.asarray(shadow_dir, dtype=np.float64)
+        direction /= np.linalg.norm(direction) or 1.0
+        planar = offsets[..., :2]
+        cos = planar @ direction / np.maximum(np.linalg.norm(planar, axis=2), 1e-9)
+        cost *= 1 + light_weight * (1 - cos) / 2
+
+    if object_boxes is not None:
+        overlap = _box_overlap(object_boxes, [b["bbox"] for b in valid_boxes])
+        cost *= 1 - overlap_weight * overlap
+
+    rows, cols = linear_sum_assignment(cost)
+
+    nearest_clusters = []
+    for r, c in zip(rows, cols):
+        distance = float(np.linalg.norm(offsets[r, c]))
+        if distance > max_distance:
+            continue
+        b = valid_boxes[c]
+        x, y = int(centroids[c, 0]), int(centroids[c, 1])
+        nearest_clusters.append(
+            {
+                "name": targets[r][0],
+                "label": b["label"],
+                "bbox": b["bbox"],
+                "centroid": (x, y, float(clusters[c, 2])),
+                "density": b["density"],
+                "distance": distance,
+            }
+        )
+    return nearest_clusters
+
+
+def adjust_depth(depth, is_in_frustum):
+    factor = 0.44 if is_in_frustum else 1.48
+    return depth + (1 - depth) * factor
+
+
+def pixel_to_camera(u, v, depth, fx, fy, cx, cy):
+    X = (u - cx) * depth / fx
+    Y = (v - cy) * depth / fy
+    Z = depth
+    return np.array([X, Y, Z])
+
+
+# camera space points of every matched shadow and object
+# since there is no given focal length, f_mm is 50 as default of Blender
+def point_pairs(targets, nearest_clusters, fov, size, is_in_frustum, f_mm=50):
+    fov_x, fov_y = fov
+    W, H = size
+
+    # compute focal length to pixel units
+    fx = f_mm * W / fov_x
+    fy = f_mm * H / fov_y
+    cx, cy = W / 2, H / 2
+
+    pairs = []
+    for name, target_point in targets:
+        match = next((c for c in nearest_clusters if c["name"] == name), None)
+        if match is None:
+            continue
+
+        x1, y1_raw, z1_raw = match["centroid"]
+        x2, y2_raw, z2_raw = target_point
+
+        y1 = H - y1_raw
+        y2 = H - y2_raw
+
+        z1 = adjust_depth(z1_raw, is_in_frustum)
+        z2 = adjust_depth(z2_raw, is_in_frustum)
+
+        point1 = pixel_to_camera(x1, y1, z1, fx, fy, cx, cy)
+        point2 = pixel_to_camera(x2, y2, z2, fx, fy, cx, cy)
+        pairs.append({"name": name, "shadow": point1, "object": point2})
+    return pairs
+
+
+def blender_vector(point):
+    return f"Vector(({point[0]:.4f}, {point[2]:.4f}, {point[1]:.4f}))"
+
+
+# the lines copied to the Blender file: blender_results.blend
+def blender_script(parent_object_name, color_flag, pairs):
+    lines = [
+        f'parent_object_name = "{parent_object_name}"',
+        f"color_flag = {color_flag}",
+        "point_pairs = [",
+    ]
+    for pair in pairs:
+        lines.append(f"({blender_vector(pair['shadow'])}, {blender_vector(pair['object'])}),")
+    lines.append("]")
+    return "\n".join(lines)
@@ -0,0 +1,326 @@
+import cv2
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.spatial
+from sklearn.cluster import DBSCAN
+
+from mask_ops import PackedMask
+
+
+def shadow_coordinates(mask):
+    y, x = np.where(mask)
+    return np.column_stack((x, y))
+
+
+# random elliptical shadows with some speckle noise, for benchmarks and tests
+def synthetic_shadow_mask(shape, n_shadows=3, seed=0):
+    rng = np.random.default_rng(seed)
+    H, W = shape
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(n_shadows):
+        center = (int(rng.uniform(0.1, 0.9) * W), int(rng.uniform(0.1, 0.9) * H))
+        axes = (int(rng.uniform(0.03, 0.12) * W), int(rng.uniform(0.03, 0.12) * H))
+        cv2.ellipse(mask, center, axes, rng.uniform(0, 180), 0, 360, 1, -1)
+    mask[rng.random(shape) > 0.998] = 1
+    return mask
+
+
+def _as_bool(mask):
+    if isinstance(mask, PackedMask):
+        return mask.to_array(np.bool_)
+    return np.asarray(mask) != 0
+
+
+def _high_density_point(cluster_points, candidates, radius):
+    kdtree = scipy.spatial.cKDTree(cluster_points)
+    density_counts = kdtree.query_ball_point(candidates, radius, return_length=True)
+    return tuple(int(v) for v in candidates[np.argmax(density_counts)])
+
+
+def _describe(label, cluster_points, density):
+    x_min, x_max = np.min(cluster_points[:, 0]), np.max(cluster_points[:, 0])
+    y_min, y_max = np.min(cluster_points[:, 1]), np.max(cluster_points[:, 1])
+
+    return {
+        "bbox": (int(x_min), int(y_min), int(x_max), int(y_max)),
+        "centroid": (int(x_min + x_max) // 2, int(y_min + y_max) // 2),
+        "density": density,
+        "label": int(label),
+        "size": len(cluster_points),
+    }
+
+
+# find the shadow clusters of a binary mask, as done in shadow_mask_with_depth.ipynb
+# levels > 0 clusters on a mask downsampled by 2**levels and refines every cluster
+# at full resolution inside its own ROI only
+def cluster_shadows(mask, eps=24, min_samples=680, radius=88, levels=0):
+    mask = _as_bool(mask)
+    if levels > 0:
+        return _cluster_coarse_to_fine(mask, eps, min_samples, radius, 2**levels)
+
+    coordinates = shadow_coordinates(mask)
+    if len(coordinates) == 0:
+        return []
+
+    labels = DBSCAN(eps=eps, min_samples=min_samples).fit_predict(coordinates)
+
+    boxes_centroids = []
+    for label in np.unique(labels):
+        if label == -1:
+            continue
+        cluster_points = coordinates[labels == label]
+        density = _high_density_point(cluster_points, cluster_points, radius)
+        boxes_centroids.append(_describe(label, cluster_points, density))
+    return boxes_centroids
+
+
+# number of shadow pixels in every scale x scale block
+def downsample_counts(mask, scale):
+    H, W = mask.shape
+    Hc, Wc = -(-H // scale), -(-W // scale)
+    padded = np.zeros((Hc * scale, Wc * scale), dtype=np.int32)
+    padded[:H, :W] = mask
+    return padded.reshape(Hc, scale, Wc, scale).sum(axis=(1, 3))
+
+
+def _disk(r):
+    k = max(int(np.floor(r)), 0)
+    yy, xx = np.mgrid[-k : k + 1, -k : k + 1]
+    return (xx**2 + yy**2 <= r**2).astype(np.float32)
+
+
+def _cluster_coarse_to_fine(mask, eps, min_samples, radius, scale):
+    H, W = mask.shape
+    counts = downsample_counts(mask, scale)
+    cy, cx = np.nonzero(counts)
+    if len(cx) == 0:
+        return []
+
+    # every coarse cell carries the number of shadow pixels it covers, so
+    # min_samples keeps its full resolution meaning and only eps is rescaled
+    cells = np.column_stack((cx, cy))
+    weights = counts[cy, cx]
+    labels = DBSCAN(eps=eps / scale, min_samples=min_samples).fit_predict(
+        cells, sample_weight=weights
+    )
+
+    cell_labels = np.full(counts.shape, -1, dtype=np.int64)
+    cell_labels[cy, cx] = labels
+    kernel = _disk(radius / scale)
+
+    boxes_centroids = []
+    for label in np.unique(labels):
+        if label == -1:
+            continue
+
+        # ROI of the cluster at full resolution
+        cluster_cells = cells[labels == label]
+        (cx0, cy0), (cx1, cy1) = cluster_cells.min(axis=0), cluster_cells.max(axis=0)
+        x0, y0 = cx0 * scale, cy0 * scale
+        x1, y1 = min((cx1 + 1) * scale, W), min((cy1 + 1) * scale, H)
+
+        roi_cells = cell_labels[cy0 : cy1 + 1, cx0 : cx1 + 1] == label
+        roi_labels = np.repeat(np.repeat(roi_cells, scale, 0), scale, 1)
+        ys, xs = np.nonzero(mask[y0:y1, x0:x1] & roi_labels[: y1 - y0, : x1 - x0])
+        cluster_points = np.column_stack((xs + x0, ys + y0))
+
+        # density peak on the coarse level, then refined around that cell only
+        roi_counts = np.where(roi_cells, counts[cy0 : cy1 + 1, cx0 : cx1 + 1], 0)
+        density = cv2.filter2D(
+            roi_counts.astype(np.float32), -1, kernel, borderType=cv2.BORDER_CONSTANT
+        )
+        density[~roi_cells] = -1
+        py, px = np.unravel_index(np.argmax(density), density.shape)
+        peak = np.array([(px + cx0) * scale, (py + cy0) * scale])
+
+        offsets = cluster_points - peak
+        candidates = cluster_points[
+            np.all((offsets >= -scale) & (offsets < 2 * scale), axis=1)
+        ]
+        near = cluster_points[np.abs(offsets).max(axis=1) <= radius + 2 * scale]
+        density = _high_density_point(near, candidates, radius)
+
+        boxes_centroids.append(_describe(label, cluster_points, density))
+    return boxes_centroids
+
+
+# number of set pixels within radius of every pixel, like a ball query per point
+def _count_within(mask, radius):
+    density = cv2.filter2D(
+        mask.astype(np.float32), -1, _disk(radius), borderType=cv2.BORDER_CONSTANT
+    )
+    return np.rint(density).astype(np.int32)
+
+
+# joins the components of core pixels that have a pair of pixels within eps
+# the closest pair of two components always lies on their boundaries, so only
+# core pixels next to a non-core pixel are searched
+def _merge_within(core, components, n, eps):
+    inner = cv2.erode(core.astype(np.uint8), np.ones((3, 3), np.uint8)).astype(bool)
+    ys, xs = np.nonzero(core & ~inner)
+    pairs = scipy.spatial.cKDTree(np.column_stack((xs, ys))).query_pairs(
+        eps, output_type="ndarray"
+    )
+    first = components[ys[pairs[:, 0]], xs[pairs[:, 0]]]
+    second = components[ys[pairs[:, 1]], xs[pairs[:, 1]]]
+    linked = first != second
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(np.count_nonzero(linked)), (first[linked], second[linked])),
+        shape=(n, n),
+    )
+    _, merged = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    return merged[components]
+
+
+# DBSCAN on the pixel grid for fast parameter sweeps
+# the neighbour counts of every pixel are density images, cached per eps, so
+# labels for a new eps/min_samples only take a few whole-image filters instead of
+# a new neighbour search: 8-connected groups of core pixels are merged when their
+# boundary pixels are within eps and border pixels join the cluster of their
+# nearest core pixel within eps
+class ClusterIndex:
+    def __init__(self, mask):
+        self.mask = _as_bool(mask)
+        self._density = {}
+
+    def density(self, radius):
+        if radius not in self._density:
+            self._density[radius] = _count_within(self.mask, radius)
+        return self._density[radius]
+
+    # H x W label image, -1 for noise and background
+    def labels(self, eps=24, min_samples=680):
+        core = self.mask & (self.density(eps) >= min_samples)
+        labels = np.full(self.mask.shape, -1, dtype=np.int32)
+        if not core.any():
+            return labels
+
+        n, components = cv2.connectedComponents(core.astype(np.uint8), connectivity=8)
+        components = _merge_within(core, components, n, eps)
+
+        # number the clusters by their first core pixel, as DBSCAN does
+        core_components = components[core]
+        ids, first = np.unique(core_components, return_index=True)
+        order = np.empty(ids.max() + 1, dtype=np.int32)
+        order[ids[np.argsort(first)]] = np.arange(len(ids))
+        core_labels = order[core_components]
+        labels[core] = core_labels
+
+        # border pixels within eps of a core pixel, found with an exact query
+        # (distance_upper_bound excludes the bound, DBSCAN includes eps itself)
+        reach = np.nextafter(eps, np.inf)
+        cy, cx = np.nonzero(core)
+        by, bx = np.nonzero(self.mask & ~core)
+        distance, nearest = scipy.spatial.cKDTree(np.column_stack((cx, cy))).query(
+            np.column_stack((bx, by)), distance_upper_bound=reach
+        )
+        within = np.isfinite(distance)
+        by, bx, border_labels = by[within], bx[within], core_labels[nearest[within]]
+
+        # DBSCAN grows its clusters one after the other, so a border pixel in reach
+        # of several clusters belongs to the one with the lowest label
+        for label in range(core_labels.max()):
+            later = border_labels > label
+            if not later.any():
+                continue
+            in_label = core_labels == label
+            points = np.column_stack((cx[in_label], cy[in_label]))
+            (x0, y0), (x1, y1) = points.min(axis=0) - eps, points.max(axis=0) + eps
+            later &= (bx >= x0) & (bx <= x1) & (by >= y0) & (by <= y1)
+            if not later.any():
+                continue
+            distance, _ = scipy.spatial.cKDTree(points).query(
+                np.column_stack((bx[later], by[later])), distance_upper_bound=reach
+            )
+            reached = np.flatnonzero(later)[np.isfinite(distance)]
+            border_labels[reached] = label
+
+        labels[by, bx] = border_labels
+        return labels
+
+    # the same cluster descriptions as cluster_shadows
+    def clusters(self, eps=24, min_samples=680, radius=88):
+        labels = self.labels(eps, min_samples)
+        ys, xs = np.nonzero(labels >= 0)
+        point_labels = labels[ys, xs]
+        order = np.argsort(point_labels, kind="stable")
+        splits = np.flatnonzero(np.diff(point_labels[order])) + 1
+
+        boxes_centroids = []
+        for index in np.split(order, splits):
+            if len(index) == 0:
+                continue
+            label = point_labels[index[0]]
+            cluster_points = np.column_stack((xs[index], ys[index]))
+            density = self._high_density_point(labels, label, cluster_points, radius)
+            boxes_centroids.append(_describe(label, cluster_points, density))
+        return boxes_centroids
+
+    # counts only the points of the same cluster, inside the cluster's ROI
+    def _high_density_point(self, labels, label, cluster_points, radius):
+        H, W = labels.shape
+        r = int(np.floor(radius))
+        (x0, y0), (x1, y1) = cluster_points.min(axis=0), cluster_points.max(axis=0)
+        x0, y0 = max(x0 - r, 0), max(y0 - r, 0)
+        x1, y1 = min(x1 + r + 1, W), min(y1 + r + 1, H)
+
+        inside = labels[y0:y1, x0:x1] == label
+        density = _count_within(inside, radius)
+        density[~inside] = -1
+        py, px = np.unravel_index(np.argmax(density), density.shape)
+        return int(px + x0), int(py + y0)
+
+    # clusters for every combination of the given parameters
+    def sweep(self, eps_values, min_samples_values, radius_values=(88,)):
+        return {
+            (eps, min_samples, radius): self.clusters(eps, min_samples, radius)
+            for eps in eps_values
+            for min_samples in min_samples_values
+            for radius in radius_values
+        }
+
+
+# masks where ClusterIndex has to agree with DBSCAN, including groups of core
+# pixels exactly eps and eps + 1 apart
+def _check_cases(eps=24):
+    for gap in (eps, eps + 1):
+        blocks = np.zeros((80, 160), dtype=np.uint8)
+        blocks[20:60, 10:40] = 1
+        blocks[20:60, 40 + gap - 1 : 70 + gap] = 1
+        yield f"blocks {gap} px apart", blocks, eps, 680
+
+        columns = np.zeros((60, 80), dtype=np.uint8)
+        columns[10:50, 10] = 1
+        columns[10:50, 10 + gap] = 1
+        yield f"columns {gap} px apart", columns, eps, 3
+
+    for seed in range(3):
+        mask = synthetic_shadow_mask((240, 320), seed=seed)
+        yield f"synthetic {seed}", mask, eps, 680
+
+    # border pixels in heavy speckle, where the nearest core pixel has to be exact
+    for seed, (speckle_eps, min_samples) in ((1, (eps, 680)), (4, (8, 120)), (5, (8, 120))):
+        mask = synthetic_shadow_mask((120, 160), seed=seed)
+        mask[np.random.default_rng(seed).random(mask.shape) < 0.3] = 1
+        yield f"speckle {seed}", mask, speckle_eps, min_samples
+
+
+def check_against_dbscan():
+    failed = 0
+    for name, mask, eps, min_samples in _check_cases():
+        labels = ClusterIndex(mask).labels(eps, min_samples)
+        coordinates = shadow_coordinates(mask)
+        expected = DBSCAN(eps=eps, min_samples=min_samples).fit_predict(coordinates)
+        actual = labels[coordinates[:, 1], coordinates[:, 0]]
+        ok = np.array_equal(actual, expected)
+        failed += not ok
+        print(
+            f"{name}: {'ok' if ok else 'MISMATCH'} "
+            f"({expected.max() + 1} DBSCAN clusters, {actual.max() + 1} grid clusters)"
+        )
+    return failed
+
+
+if __name__ == "__main__":
+    raise SystemExit(check_against_dbscan())
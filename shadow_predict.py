@@ -0,0 +1,186 @@
+import os
+from PIL import Image
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
+from model import SHADOW, ResNetUNet
+from autotune import apply_profile, setting
+
+## normalisation for ISTD_resnet.pth
+MEAN = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+STD = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+# ToTensor and Normalize folded into one multiply-add on the uint8 values
+SCALE = 1 / (255 * STD)
+SHIFT = -MEAN / STD
+
+
+def get_device():
+    return (
+        torch.device("mps")
+        if torch.backends.mps.is_available()
+        else torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    )
+
+
+# decode straight into an H x W x 3 uint8 tensor, returns it with the original size
+# for JPEGs, draft mode lets libjpeg downscale in the DCT domain by up to 8x while
+# keeping both sides at least draft_size, so large photos are never fully decoded
+def load_image(image_path, draft_size=None):
+    img = Image.open(image_path)
+    size = img.size
+    if draft_size is not None:
+        img.draft("RGB", draft_size)
+    array = np.array(img.convert("RGB"))
+    return torch.from_numpy(array), size
+
+
+# resize and normalise a list of H x W x 3 uint8 images into one model batch
+def preprocess(images, size=(256, 256)):
+    batch = torch.cat(
+        [
+            F.interpolate(
+                image.permute(2, 0, 1).unsqueeze(0).float(),
+                size=size,
+                mode="bilinear",
+                align_corners=False,
+                antialias=True,
+            )
+            for image in images
+        ]
+    )
+    return torch.addcmul(SHIFT, batch, SCALE)
+
+
+# upsample the model output to (W, H) on the tensor and convert it once to uint8
+def postprocess(pred, size, threshold=None):
+    W, H = size
+    pred = F.interpolate(pred, size=(H, W), mode="bilinear", align_corners=False)
+    if threshold is not None:
+        pred = (pred > threshold).float()
+    return pred.mul_(255).byte().cpu().numpy()[:, 0]
+
+
+# thread settings found by autotune.py for SHADOW on this machine, if it was run
+def load_ISTD(model_path, device):
+    apply_profile(model="istd")
+    net = SHADOW().to(device)
+    net.load_state_dict(torch.load(model_path, map_location=device))
+    net.eval()
+    return net
+
+
+def run_mine(img_path, model_path):
+    apply_profile(model="mine")
+    device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
+    model = ResNetUNet().to(device)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.eval()
+
+    try:
+        img = Image.open(img_path).convert("RGB")
+    except Exception as e:
+        print(f"Cannot load image: {e}")
+        return
+
+    img_tensor = TF.to_tensor(img).unsqueeze(0).to(device)
+
+    with torch.no_grad():
+        pred_mask = model(img_tensor)[0, 0]
+        binary_mask = (pred_mask > 0.5).float()
+        mask_img = TF.to_pil_image(binary_mask.cpu())
+
+        base, _ = os.path.splitext(img_path)
+        mask_save_path = base + "_mask.png"
+        mask_img.save(mask_save_path)
+        print(f"Saved mask to {mask_save_path}")
+
+
+def run_ISTD(image_path, model_path, threshold=None):
+    device = get_device()
+    net = load_ISTD(model_path, device)
+
+    image, size = load_image(image_path, draft_size=(256, 256))
+
+    with torch.no_grad():
+        output = net(preprocess([image]).to(device))
+    output = postprocess(output, size, threshold)[0]
+
+    base, _ = os.path.splitext(image_path)
+    mask_save_path = base + "_mask.png"
+    cv2.imwrite(mask_save_path, output)
+    print(f"Saved mask to {mask_save_path}")
+
+
+# regions around the detected objects where their shadows can be
+# each box is grown by expand times its size on every side, and by reach times its
+# size towards shadow_dir, the (dx, dy) image direction the shadows fall in
+def object_rois(object_masks, expand=0.5, shadow_dir=None, reach=1.0, min_size=64):
+    rois = []
+    for mask in object_masks:
+        if mask is None:
+            continue
+        ys, xs = np.nonzero(mask)
+        if len(xs) == 0:
+            continue
+        H, W = mask.shape[:2]
+        x0, x1 = xs.min(), xs.max() + 1
+        y0, y1 = ys.min(), ys.max() + 1
+        bw, bh = max(x1 - x0, min_size), max(y1 - y0, min_size)
+
+        left = right = expand * bw
+        top = bottom = expand * bh
+        if shadow_dir is not None:
+            dx, dy = shadow_dir
+            norm = np.hypot(dx, dy) or 1.0
+            dx, dy = dx / norm, dy / norm
+            right += max(dx, 0) * reach * bw
+            left += max(-dx, 0) * reach * bw
+            bottom += max(dy, 0) * reach * bh
+            top += max(-dy, 0) * reach * bh
+
+        rois.append(
+            (
+                int(max(x0 - left, 0)),
+                int(max(y0 - top, 0)),
+                int(min(x1 + right, W)),
+                int(min(y1 + bottom, H)),
+            )
+        )
+    return rois
+
+
+# run SHADOW on every ROI at the model resolution and paste the results back
+# into a full frame mask, overlapping ROIs keep the larger value
+def predict_rois(net, image, rois, device, batch_size=None):
+    batch_size = batch_size or setting("batch_size", model="istd")
+    H, W = image.shape[:2]
+    output = np.zeros((H, W), dtype=np.uint8)
+
+    with torch.no_grad():
+        for i in range(0, len(rois), batch_size):
+            batch_rois = rois[i : i + batch_size]
+            batch = preprocess([image[y0:y1, x0:x1] for x0, y0, x1, y1 in batch_rois])
+            pred = net(batch.to(device))
+
+            for (x0, y0, x1, y1), mask in zip(batch_rois, pred):
+                mask = postprocess(mask.unsqueeze(0), (x1 - x0, y1 - y0))[0]
+                np.maximum(output[y0:y1, x0:x1], mask, out=output[y0:y1, x0:x1])
+    return output
+
+
+def run_ISTD_roi(image_path, model_path, object_masks, **roi_kwargs):
+    device = get_device()
+    net = load_ISTD(model_path, device)
+
+    # crops need the full resolution, so no draft mode here
+    image, _ = load_image(image_path)
+    rois = object_rois(object_masks, **roi_kwargs)
+    output = predict_rois(net, image, rois, device)
+
+    base, _ = os.path.splitext(image_path)
+    mask_save_path = base + "_mask.png"
+    cv2.imwrite(mask_save_path, output)
+    print(f"Saved mask to {mask_save_path} from {len(rois)} ROIs")
+    return output
@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+from model import SHADOW, ResNetUNet
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+
+# same normalisation as run_ISTD
+MEAN = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+STD = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+
+# image/mask pairs with the same file name, e.g. ISTD train_A and train_B
+def find_pairs(image_dir, mask_dir):
+    masks = {
+        os.path.splitext(name)[0]: os.path.join(mask_dir, name)
+        for name in os.listdir(mask_dir)
+        if name.lower().endswith(IMAGE_EXTS)
+    }
+    pairs = []
+    for name in sorted(os.listdir(image_dir)):
+        stem = os.path.splitext(name)[0]
+        if name.lower().endswith(IMAGE_EXTS) and stem in masks:
+            pairs.append((os.path.join(image_dir, name), masks[stem]))
+    return pairs
+
+
+# decode and resize every pair once into two memory-mapped arrays
+def build_cache(pairs, cache_dir, size=256):
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_path = os.path.join(cache_dir, "meta.json")
+    meta = {"size": size, "pairs": [list(p) for p in pairs]}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == meta:
+                return cache_dir
+
+    images = np.lib.format.open_memmap(
+        os.path.join(cache_dir, "images.npy"), "w+", np.uint8, (len(pairs), size, size, 3)
+    )
+    masks = np.lib.format.open_memmap(
+        os.path.join(cache_dir, "masks.npy"), "w+", np.uint8, (len(pairs), size, size)
+    )
+    for i, (image_path, mask_path) in enumerate(pairs):
+        img = Image.open(image_path)
+        img.draft("RGB", (size, size))
+        images[i] = np.asarray(img.convert("RGB").resize((size, size), Image.BILINEAR))
+        mask = Image.open(mask_path).convert("L").resize((size, size), Image.NEAREST)
+        masks[i] = np.asarray(mask) > 127
+    images.flush()
+    masks.flush()
+
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    return cache_dir
+
+
+# random images with darkened ellipses as shadows, for testing without a dataset
+def build_synthetic_cache(cache_dir, n, size=256, seed=0):
+    os.makedirs(cache_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    images = np.lib.format.open_memmap(
+        os.path.join(cache_dir, "images.npy"), "w+", np.uint8, (n, size, size, 3)
+    )
+    masks = np.lib.format.open_memmap(
+        os.path.join(cache_dir, "masks.npy"), "w+", np.uint8, (n, size, size)
+    )
+    yy, xx = np.mgrid[:size, :size]
+    for i in range(n):
+        cx, cy = rng.uniform(0.2, 0.8, 2) * size
+        rx, ry = rng.uniform(0.05, 0.25, 2) * size
+        shadow = ((xx - cx) / rx) ** 2 + ((yy - cy) / ry) ** 2 <= 1
+        image = rng.integers(120, 256, (size, size, 3))
+        image[shadow] //= 3
+        images[i] = image
+        masks[i] = shadow
+    images.flush()
+    masks.flush()
+
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump({"size": size, "synthetic": n}, f)
+    return cache_dir
+
+
+class ShadowDataset(Dataset):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.images = None
+        self.masks = None
+        self.length = len(np.load(os.path.join(cache_dir, "masks.npy"), mmap_mode="r"))
+
+    # opened lazily so every worker maps the files itself
+    def _open(self):
+        self.images = np.load(os.path.join(self.cache_dir, "images.npy"), mmap_mode="r")
+        self.masks = np.load(os.path.join(self.cache_dir, "masks.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self._open()
+        image = torch.from_numpy(np.array(self.images[index]))
+        mask = torch.from_numpy(np.array(self.masks[index]))
+        return image, mask
+
+
+# augmentation on a whole uint8 batch at once: flips, brightness and contrast
+def augment(images, masks, normalize=True):
+    images = images.permute(0, 3, 1, 2).float().div_(255)
+    masks = masks.unsqueeze(1).float()
+    B = images.shape[0]
+    device = images.device
+
+    flip = torch.rand(B, 1, 1, 1, device=device) < 0.5
+    images = torch.where(flip, images.flip(-1), images)
+    masks = torch.where(flip, masks.flip(-1), masks)
+
+    brightness = torch.empty(B, 1, 1, 1, device=device).uniform_(-0.1, 0.1)
+    contrast = torch.empty(B, 1, 1, 1, device=device).uniform_(0.8, 1.2)
+    mean = images.mean(dim=(1, 2, 3), keepdim=True)
+    images = ((images - mean) * contrast + mean + brightness).clamp_(0, 1)
+
+    if normalize:
+        images = (images - MEAN.to(device)) / STD.to(device)
+    return images, masks
+
+
+def build_model(name, pretrained=True):
+    if name == "istd":
+        return SHADOW(pretrained)
+    return ResNetUNet(pretrained)
+
+
+def train(args):
+    device = torch.device(args.device)
+
+    if args.synthetic:
+        cache_dir = build_synthetic_cache(args.cache, args.synthetic, args.size)
+    else:
+        pairs = find_pairs(args.images, args.masks)
+        if not pairs:
+            raise ValueError(f"No image/mask pairs found in {args.images} and {args.masks}")
+        cache_dir = build_cache(pairs, args.cache, args.size)
+
+    dataset = ShadowDataset(cache_dir)
+    loader = DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        shuffle=True,
+        num_workers=args.workers,
+        persistent_workers=args.workers > 0,
+        pin_memory=device.type == "cuda",
+        drop_last=len(dataset) > args.batch_size,
+    )
+
+    net = build_model(args.model, pretrained=not args.no_pretrained).to(device)
+    if args.init:
+        net.load_state_dict(torch.load(args.init, map_location=device))
+    if args.checkpoint:
+        net.checkpoint_backbone = True
+    net.train()
+
+    optimizer = torch.optim.Adam(net.parameters(), lr=args.lr)
+    criterion = nn.BCELoss()
+    # run_mine feeds plain ToTensor images, run_ISTD normalised ones
+    normalize = args.model == "istd"
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+
+    for epoch in range(args.epochs):
+        total_loss, samples = 0.0, 0
+        start = time.perf_counter()
+
+        for images, masks in loader:
+            images, masks = augment(
+                images.to(device, non_blocking=True),
+                masks.to(device, non_blocking=True),
+                normalize,
+            )
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16):
+                pred = net(images)
+            loss = criterion(pred.float(), masks)
+
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+
+            total_loss += loss.item() * len(images)
+            samples += len(images)
+
+        elapsed = time.perf_counter() - start
+        print(
+            f"Epoch {epoch + 1}/{args.epochs}: loss {total_loss / max(samples, 1):.4f}, "
+            f"{samples / elapsed:.1f} samples/s"
+        )
+
+        # same format run_ISTD and run_mine load
+        torch.save(net.state_dict(), args.out)
+        print(f"Saved checkpoint to {args.out}")
+    return net
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Train or fine-tune the shadow models")
+    parser.add_argument("--model", choices=["istd", "mine"], default="istd")
+    parser.add_argument("--images", help="directory of input images")
+    parser.add_argument("--masks", help="directory of shadow masks with the same names")
+    parser.add_argument("--synthetic", type=int, default=0, help="use N synthetic samples")
+    parser.add_argument("--cache", default="cache/train")
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--init", help="checkpoint to fine-tune from")
+    parser.add_argument("--out", default="models/finetuned.pth")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--bf16", action="store_true", help="bfloat16 autocast")
+    parser.add_argument(
+        "--checkpoint", action="store_true", help="activation checkpointing of the ResNeXt stages"
+    )
+    parser.add_argument(
+        "--no-pretrained", action="store_true", help="do not load the ImageNet backbone weights"
+    )
+    args = parser.parse_args(argv)
+
+    if not args.synthetic and not (args.images and args.masks):
+        parser.error("--images and --masks are required unless --synthetic is given")
+    if args.checkpoint and args.model != "istd":
+        parser.error("--checkpoint is only supported for --model istd")
+    return args
+
+
+if __name__ == "__main__":
+    train(parse_args())